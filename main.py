@@ -10,17 +10,23 @@ import asyncio
 import logging
 import os
 import json
-from datetime import datetime, timedelta
+import random
+import re
+import signal
+import time
+import uuid
+from datetime import date, datetime, timedelta
 from typing import Optional, List, Dict
 import asyncpg
 import websockets
 from websockets.server import WebSocketServerProtocol
-from collections import defaultdict
+from collections import defaultdict, deque
 from contextlib import asynccontextmanager
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
 import aiohttp
 from dataclasses import dataclass
+from types import SimpleNamespace
 
 # Конфигурация
 @dataclass
@@ -33,6 +39,48 @@ class Config:
     DB_MIN_SIZE: int = 1
     DB_MAX_SIZE: int = 3
     DB_COMMAND_TIMEOUT: int = 30
+    FEED_EVENT_BUFFER_SIZE: int = int(os.getenv("FEED_EVENT_BUFFER_SIZE", "1000"))
+    # Ограничения WebSocket сервера
+    WS_MAX_CONNECTIONS: int = int(os.getenv("WS_MAX_CONNECTIONS", "5000"))
+    WS_MAX_CONNECTIONS_PER_IP: int = int(os.getenv("WS_MAX_CONNECTIONS_PER_IP", "50"))
+    # Адреса прокси, которым доверяем X-Forwarded-For (через запятую, пусто - не доверяем)
+    TRUSTED_PROXIES: tuple = tuple(ip.strip() for ip in os.getenv("TRUSTED_PROXIES", "").split(",") if ip.strip())
+    WS_MAX_MESSAGE_SIZE: int = int(os.getenv("WS_MAX_MESSAGE_SIZE", str(64 * 1024)))
+    WS_PING_INTERVAL: int = int(os.getenv("WS_PING_INTERVAL", "20"))
+    WS_PING_TIMEOUT: int = int(os.getenv("WS_PING_TIMEOUT", "20"))
+    # Отключение клиентов, которые ничего не отправляют (0 - выключено).
+    # Мертвые соединения и так закрывает ping/pong, это только для молчащих клиентов
+    WS_IDLE_TIMEOUT: int = int(os.getenv("WS_IDLE_TIMEOUT", "0"))
+    WS_IDLE_CHECK_INTERVAL: int = 60
+    # Сброс нагрузки: сколько запросов может ждать соединение из пула
+    DB_MAX_QUEUE: int = int(os.getenv("DB_MAX_QUEUE", "20"))
+    OVERLOAD_RETRY_AFTER: int = 2
+    # Остановка и перезапуск
+    SHUTDOWN_DRAIN_TIMEOUT: int = int(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "15"))
+    RECONNECT_BASE_DELAY: float = 1.0
+    RECONNECT_JITTER: float = 5.0
+    REUSE_PORT: bool = os.getenv("REUSE_PORT", "0") == "1"
+    # Сортировка "hot": период пересчета и вес времени в рейтинге
+    HOT_REFRESH_INTERVAL: int = int(os.getenv("HOT_REFRESH_INTERVAL", "30"))
+    HOT_DECAY_SECONDS: int = 45000
+    # Раз во сколько проходов дозаполнять рейтинг постов, потерянных при аварийном рестарте
+    HOT_BACKFILL_EVERY: int = 20
+    # Архивация и партиционирование постов
+    ARCHIVE_INTERVAL: int = int(os.getenv("ARCHIVE_INTERVAL", "3600"))
+    ARCHIVE_BATCH_SIZE: int = 500
+    ARCHIVE_REJECTED_AFTER_DAYS: int = int(os.getenv("ARCHIVE_REJECTED_AFTER_DAYS", "7"))
+    # Срок жизни одобренных постов в ленте (0 - не истекают, архивируются только отклоненные)
+    POST_TTL_DAYS: int = int(os.getenv("POST_TTL_DAYS", "0"))
+    PARTITION_MONTHS_AHEAD: int = 2
+    # Сколько обработчик ждет бота, если он еще инициализируется после старта
+    BOT_READY_TIMEOUT: int = 15
+    # Жалобы: порог автоскрытия и задержка обновления сводки для модераторов
+    REPORT_AUTO_HIDE_THRESHOLD: int = int(os.getenv("REPORT_AUTO_HIDE_THRESHOLD", "5"))
+    REPORT_SUMMARY_DELAY: int = int(os.getenv("REPORT_SUMMARY_DELAY", "10"))
+    # Запись входящего трафика для replay.py (пусто - выключено)
+    CAPTURE_PATH: str = os.getenv("CAPTURE_PATH", "")
+    # Заглушка вместо Telegram API для локальных прогонов replay.py
+    TELEGRAM_STUB: bool = os.getenv("TELEGRAM_STUB", "0") == "1"
 
 config = Config()
 
@@ -47,16 +95,45 @@ connected_clients = set()
 post_limits = defaultdict(list)  # Кеш лимитов в памяти
 posts_cache = {}  # Кеш постов в памяти
 user_cache = {}   # Кеш пользователей в памяти
+client_ips = {}          # websocket -> IP клиента
+client_last_seen = {}    # websocket -> время последнего сообщения
+ip_connections = defaultdict(int)
+ws_stats = defaultdict(int)  # Счетчики отказов и отключений
+db_stats = {'waiting': 0}    # Очередь ожидания соединения из пула
+server_state = {'shutting_down': False, 'inflight': 0}
+inflight_done = asyncio.Event()
+shutdown_hooks = []  # Корутины для сброса отложенных записей при остановке
+dirty_hot_posts = set()  # Посты, чей рейтинг "hot" нужно пересчитать
+bot_ready = asyncio.Event()
+startup_stats = {}  # Время готовности подсистем в секундах от старта
+report_summary_tasks = {}  # post_id -> отложенное обновление сводки жалоб
+last_reporters = {}        # post_id -> данные последнего пожаловавшегося
 
 # База данных
 @asynccontextmanager
 async def get_db_connection():
-    async with db_pool.acquire() as connection:
-        try:
-            yield connection
-        except Exception as e:
-            logger.error(f"Database error: {e}")
-            raise
+    db_stats['waiting'] += 1
+    acquired = False
+    try:
+        async with db_pool.acquire() as connection:
+            db_stats['waiting'] -= 1
+            acquired = True
+            try:
+                yield connection
+            except Exception as e:
+                logger.error(f"Database error: {e}")
+                raise
+    finally:
+        if not acquired:
+            db_stats['waiting'] -= 1
+
+# Рейтинг "hot": логарифм лайков плюс время создания, деленное на HOT_DECAY_SECONDS.
+# Значение не меняется со временем, поэтому пересчитывать нужно только посты
+# с новыми лайками, а свежие посты все равно обгоняют старые.
+HOT_SCORE_SQL = """
+    (SIGN(p.likes::DOUBLE PRECISION) * LOG(GREATEST(ABS(p.likes), 1)::DOUBLE PRECISION)
+     + EXTRACT(EPOCH FROM p.created_at)::DOUBLE PRECISION / $1::DOUBLE PRECISION)
+"""
 
 class DatabaseService:
     @staticmethod
@@ -73,61 +150,298 @@ class DatabaseService:
         )
         
         async with get_db_connection() as conn:
-            # Создаем таблицы если не существуют
+            # Если схема актуальна, это единственный запрос при старте
+            try:
+                current_version = await conn.fetchval("SELECT MAX(version) FROM schema_migrations")
+            except asyncpg.UndefinedTableError:
+                current_version = None
+            
+            if (current_version or 0) < len(SCHEMA_MIGRATIONS):
+                await DatabaseService._apply_migrations(conn)
+        
+        logger.info("Database initialized")
+
+    @staticmethod
+    async def _apply_migrations(conn):
+        async with conn.transaction():
+            # Несколько процессов (REUSE_PORT) не должны мигрировать одновременно
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
             await conn.execute("""
-                CREATE TABLE IF NOT EXISTS posts (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    description TEXT NOT NULL,
-                    category TEXT NOT NULL,
-                    tags JSONB NOT NULL DEFAULT '[]',
-                    likes INTEGER DEFAULT 0,
-                    status TEXT DEFAULT 'pending',
-                    moderation_message_id INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    creator JSONB NOT NULL
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            current_version = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
             
+            for version, migration in enumerate(SCHEMA_MIGRATIONS, start=1):
+                if version <= current_version:
+                    continue
+                logger.info(f"Applying schema migration {version}: {migration.__name__}")
+                await migration(conn)
+                await conn.execute("INSERT INTO schema_migrations (version) VALUES ($1)", version)
+
+    # Миграции схемы. Новые изменения добавляются отдельной функцией в конец SCHEMA_MIGRATIONS
+    @staticmethod
+    async def _migration_base_schema(conn):
+        # Создаем таблицы если не существуют
+        # posts партиционирована по месяцам created_at
+        posts_kind = await conn.fetchval("SELECT relkind FROM pg_class WHERE oid = to_regclass('posts')")
+        if posts_kind is None:
+            async with conn.transaction():
+                await DatabaseService._create_partitioned_posts(conn)
+        elif posts_kind == 'r':
+            await DatabaseService._migrate_posts_to_partitions(conn)
+        await DatabaseService.ensure_post_partitions(conn)
+        
+        # Холодное хранилище для отклоненных и устаревших постов
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS posts_archive (
+                LIKE posts,
+                archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS post_reports (
+                id SERIAL PRIMARY KEY,
+                post_id BIGINT NOT NULL,
+                reporter_id BIGINT NOT NULL,
+                reason TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                photo_url TEXT,
+                favorites BIGINT[] DEFAULT '{}',
+                hidden BIGINT[] DEFAULT '{}',
+                liked BIGINT[] DEFAULT '{}',
+                reported_posts BIGINT[] DEFAULT '{}',
+                posts BIGINT[] DEFAULT '{}',
+                is_banned BOOLEAN DEFAULT FALSE,
+                ban_reason TEXT,
+                post_limit INTEGER DEFAULT 60,
+                last_post_count_reset DATE DEFAULT CURRENT_DATE,
+                posts_today INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Избранное и скрытые посты как отдельные связи (вместо массивов в users)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_favorites (
+                user_id BIGINT NOT NULL,
+                post_id BIGINT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, post_id)
+            )
+        """)
+        
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_hidden_posts (
+                user_id BIGINT NOT NULL,
+                post_id BIGINT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, post_id)
+            )
+        """)
+        
+        # Рейтинг "hot", пересчитывается фоновой задачей
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS post_scores (
+                post_id BIGINT PRIMARY KEY,
+                score DOUBLE PRECISION NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Количество одобренных постов по каждому тегу (фасеты фильтров)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS tag_counts (
+                tag TEXT PRIMARY KEY,
+                approved_count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        
+        # Первичное заполнение фасетов
+        if not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM tag_counts)"):
             await conn.execute("""
-                CREATE TABLE IF NOT EXISTS post_reports (
-                    id SERIAL PRIMARY KEY,
-                    post_id INTEGER REFERENCES posts(id),
-                    reporter_id BIGINT NOT NULL,
-                    reason TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
+                INSERT INTO tag_counts (tag, approved_count)
+                SELECT t, COUNT(DISTINCT p.id) FROM posts p, jsonb_array_elements_text(p.tags) t
+                WHERE p.status = 'approved'
+                GROUP BY t
             """)
+        
+        # Переносим старые данные из массивов users.favorites / users.hidden
+        await conn.execute("""
+            INSERT INTO user_favorites (user_id, post_id)
+            SELECT user_id, unnest(favorites) FROM users WHERE cardinality(favorites) > 0
+            ON CONFLICT DO NOTHING
+        """)
+        await conn.execute("""
+            INSERT INTO user_hidden_posts (user_id, post_id)
+            SELECT user_id, unnest(hidden) FROM users WHERE cardinality(hidden) > 0
+            ON CONFLICT DO NOTHING
+        """)
+        await conn.execute("""
+            UPDATE users SET favorites = '{}', hidden = '{}'
+            WHERE cardinality(favorites) > 0 OR cardinality(hidden) > 0
+        """)
+        
+        # Индексы
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_user_id ON posts(user_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_category ON posts(category)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_status ON posts(status)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts(created_at DESC)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id)")
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_posts_approved_created_at
+            ON posts(created_at DESC) WHERE status = 'approved'
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_favorites_post_id ON user_favorites(post_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_hidden_posts_post_id ON user_hidden_posts(post_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_post_scores_score ON post_scores(score DESC)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_post_reports_post_id ON post_reports(post_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_archive_id ON posts_archive(id)")
+        
+        # Заполняем рейтинг для одобренных постов, у которых его еще нет
+        await conn.execute(f"""
+            INSERT INTO post_scores (post_id, score)
+            SELECT p.id, {HOT_SCORE_SQL} FROM posts p
+            WHERE p.status = 'approved'
+              AND NOT EXISTS (SELECT 1 FROM post_scores s WHERE s.post_id = p.id)
+        """, config.HOT_DECAY_SECONDS)
+
+    @staticmethod
+    async def _migration_report_counts(conn):
+        # Одна жалоба от пользователя на пост
+        await conn.execute("""
+            DELETE FROM post_reports a USING post_reports b
+            WHERE a.post_id = b.post_id AND a.reporter_id = b.reporter_id AND a.id > b.id
+        """)
+        await conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_post_reports_post_reporter
+            ON post_reports(post_id, reporter_id)
+        """)
+        
+        # Счетчик жалоб и сообщение-сводка у модераторов
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS post_report_counts (
+                post_id BIGINT PRIMARY KEY,
+                report_count INTEGER NOT NULL DEFAULT 0,
+                last_reason TEXT,
+                moderation_message_id BIGINT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        await conn.execute("""
+            INSERT INTO post_report_counts (post_id, report_count)
+            SELECT post_id, COUNT(*) FROM post_reports GROUP BY post_id
+            ON CONFLICT (post_id) DO NOTHING
+        """)
+
+    @staticmethod
+    async def _migration_tag_counts_by_category(conn):
+        # Фасеты считаются в разрезе категории, как и запросы ленты
+        await conn.execute("DROP TABLE IF EXISTS tag_counts")
+        await conn.execute("""
+            CREATE TABLE tag_counts (
+                category TEXT NOT NULL,
+                tag TEXT NOT NULL,
+                approved_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (category, tag)
+            )
+        """)
+        await conn.execute("""
+            INSERT INTO tag_counts (category, tag, approved_count)
+            SELECT p.category, t, COUNT(DISTINCT p.id) FROM posts p, jsonb_array_elements_text(p.tags) t
+            WHERE p.status = 'approved'
+            GROUP BY p.category, t
+        """)
+
+    @staticmethod
+    async def _migration_link_post_created_at(conn):
+        # Ключ партиционирования рядом с post_id: join по (id, created_at) не обходит все партиции
+        for table in ('user_favorites', 'user_hidden_posts', 'post_scores'):
+            await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS post_created_at TIMESTAMP")
+            await conn.execute(f"""
+                UPDATE {table} l SET post_created_at = p.created_at
+                FROM posts p WHERE p.id = l.post_id AND l.post_created_at IS NULL
+            """)
+
+    @staticmethod
+    async def _create_partitioned_posts(conn):
+        # Первичный ключ партиционированной таблицы должен включать created_at
+        await conn.execute("CREATE SEQUENCE IF NOT EXISTS posts_id_seq")
+        await conn.execute("""
+            CREATE TABLE posts (
+                id BIGINT NOT NULL DEFAULT nextval('posts_id_seq'),
+                user_id BIGINT NOT NULL,
+                description TEXT NOT NULL,
+                category TEXT NOT NULL,
+                tags JSONB NOT NULL DEFAULT '[]',
+                likes INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'pending',
+                moderation_message_id INTEGER,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                creator JSONB NOT NULL,
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        """)
+        await conn.execute("CREATE TABLE posts_default PARTITION OF posts DEFAULT")
+        await conn.execute("ALTER SEQUENCE posts_id_seq OWNED BY posts.id")
+
+    @staticmethod
+    async def _migrate_posts_to_partitions(conn):
+        logger.info("Migrating posts to a partitioned table")
+        async with conn.transaction():
+            await conn.execute("ALTER TABLE posts RENAME TO posts_legacy")
+            # Последовательность SERIAL не должна удалиться вместе со старой таблицей
+            await conn.execute("ALTER SEQUENCE posts_id_seq OWNED BY NONE")
+            await conn.execute("ALTER TABLE IF EXISTS post_reports DROP CONSTRAINT IF EXISTS post_reports_post_id_fkey")
+            await DatabaseService._create_partitioned_posts(conn)
             
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    photo_url TEXT,
-                    favorites BIGINT[] DEFAULT '{}',
-                    hidden BIGINT[] DEFAULT '{}',
-                    liked BIGINT[] DEFAULT '{}',
-                    reported_posts BIGINT[] DEFAULT '{}',
-                    posts BIGINT[] DEFAULT '{}',
-                    is_banned BOOLEAN DEFAULT FALSE,
-                    ban_reason TEXT,
-                    post_limit INTEGER DEFAULT 60,
-                    last_post_count_reset DATE DEFAULT CURRENT_DATE,
-                    posts_today INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
+            months = await conn.fetch("""
+                SELECT DISTINCT date_trunc('month', created_at)::DATE AS month
+                FROM posts_legacy WHERE created_at IS NOT NULL
             """)
+            for row in months:
+                await DatabaseService._create_month_partition(conn, row['month'])
+            # Строки без created_at получат текущее время: партиция текущего месяца нужна до вставки,
+            # иначе они попадут в posts_default и создать ее позже уже не получится
+            await DatabaseService.ensure_post_partitions(conn)
             
-            # Индексы
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_user_id ON posts(user_id)")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_category ON posts(category)")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_status ON posts(status)")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts(created_at DESC)")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id)")
-        
-        logger.info("Database initialized")
+            await conn.execute("""
+                INSERT INTO posts (id, user_id, description, category, tags, likes, status,
+                                   moderation_message_id, created_at, creator)
+                SELECT id, user_id, description, category, tags, likes, status,
+                       moderation_message_id, COALESCE(created_at, CURRENT_TIMESTAMP), creator
+                FROM posts_legacy
+            """)
+            await conn.execute("DROP TABLE posts_legacy")
+            await conn.execute("ALTER TABLE IF EXISTS post_reports ALTER COLUMN post_id TYPE BIGINT")
+
+    @staticmethod
+    async def _create_month_partition(conn, month: date):
+        next_month = (month.replace(day=1) + timedelta(days=32)).replace(day=1)
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS posts_{month:%Y_%m} PARTITION OF posts
+            FOR VALUES FROM ('{month:%Y-%m-01}') TO ('{next_month:%Y-%m-%d}')
+        """)
+
+    @staticmethod
+    async def ensure_post_partitions(conn):
+        # Партиции создаются заранее, чтобы новые посты не попадали в posts_default
+        month = date.today().replace(day=1)
+        for _ in range(config.PARTITION_MONTHS_AHEAD + 1):
+            await DatabaseService._create_month_partition(conn, month)
+            month = (month + timedelta(days=32)).replace(day=1)
 
     @staticmethod
     async def sync_user(user_data: Dict) -> Dict:
@@ -192,66 +506,80 @@ class DatabaseService:
     @staticmethod
     async def get_posts(filters: Dict, page: int, limit: int, search: str = '', user_id: int = None) -> List[Dict]:
         async with get_db_connection() as conn:
+            # $1 всегда id текущего пользователя (может быть NULL)
+            params = [user_id]
+            sort_type = filters.get('filters', {}).get('sort', 'new')
+            
             query = """
                 SELECT p.*, 
-                       (CASE WHEN $10::BIGINT = ANY(u.liked) THEN TRUE ELSE FALSE END) as user_liked
+                       (CASE WHEN $1::BIGINT = ANY(u.liked) THEN TRUE ELSE FALSE END) as user_liked
                 FROM posts p
-                LEFT JOIN users u ON u.user_id = $10
+            """
+            
+            # Специальные представления: join по индексированным таблицам связей.
+            # created_at в условии позволяет отсечь лишние партиции posts
+            if sort_type == 'favorites' and user_id:
+                query += """
+                    JOIN user_favorites f ON f.post_id = p.id AND f.post_created_at = p.created_at
+                     AND f.user_id = $1::BIGINT
+                """
+            elif sort_type == 'hidden' and user_id:
+                query += """
+                    JOIN user_hidden_posts h ON h.post_id = p.id AND h.post_created_at = p.created_at
+                     AND h.user_id = $1::BIGINT
+                """
+            elif sort_type == 'hot':
+                query += " JOIN post_scores s ON s.post_id = p.id AND s.post_created_at = p.created_at"
+            
+            query += """
+                LEFT JOIN users u ON u.user_id = $1::BIGINT
                 WHERE p.status = 'approved'
             """
-            params = [filters.get('category', '')]
-            param_count = 1
+            
+            if sort_type == 'my' and user_id:
+                query += " AND p.user_id = $1::BIGINT"
+            
+            # Скрытые пользователем посты исключаем из обычной ленты (anti-join)
+            if sort_type != 'hidden' and user_id:
+                query += """
+                    AND NOT EXISTS (
+                        SELECT 1 FROM user_hidden_posts hp
+                        WHERE hp.user_id = $1::BIGINT AND hp.post_id = p.id
+                    )
+                """
             
             # Категория
             if filters.get('category'):
-                param_count += 1
-                query += f" AND p.category = ${param_count}"
                 params.append(filters['category'])
+                query += f" AND p.category = ${len(params)}"
             
             # Поиск
             if search:
-                param_count += 1
-                query += f" AND LOWER(p.description) LIKE LOWER(${param_count})"
                 params.append(f"%{search}%")
+                query += f" AND LOWER(p.description) LIKE LOWER(${len(params)})"
             
             # Фильтры по тегам
             if filters.get('filters'):
                 for filter_type, values in filters['filters'].items():
                     if values and filter_type != 'sort' and isinstance(values, list):
                         for value in values:
-                            param_count += 1
-                            query += f" AND p.tags @> ${param_count}"
                             params.append(json.dumps([f"{filter_type}:{value}"]))
-            
-            # Специальные фильтры
-            if filters.get('filters', {}).get('sort'):
-                sort_type = filters['filters']['sort']
-                if sort_type == 'my' and user_id:
-                    query += f" AND p.user_id = ${len(params) + 1}"
-                    params.append(user_id)
-                elif sort_type == 'favorites' and user_id:
-                    query += f" AND p.id = ANY((SELECT favorites FROM users WHERE user_id = ${len(params) + 1}))"
-                    params.append(user_id)
-                elif sort_type == 'hidden' and user_id:
-                    query += f" AND p.id = ANY((SELECT hidden FROM users WHERE user_id = ${len(params) + 1}))"
-                    params.append(user_id)
+                            query += f" AND p.tags @> ${len(params)}::jsonb"
             
             # Сортировка
-            sort_type = filters.get('filters', {}).get('sort', 'new')
             if sort_type == 'old':
                 query += " ORDER BY p.created_at ASC"
             elif sort_type == 'rating':
                 query += " ORDER BY p.likes DESC, p.created_at DESC"
+            elif sort_type == 'hot':
+                query += " ORDER BY s.score DESC"
             else:
                 query += " ORDER BY p.created_at DESC"
             
-            # Добавляем недостающие параметры до $10
-            while len(params) < 10:
-                params.append(None)
+            params.extend([limit, (page - 1) * limit])
+            query += f" LIMIT ${len(params) - 1} OFFSET ${len(params)}"
             
-            query += f" LIMIT {limit} OFFSET {(page - 1) * limit}"
-            
-            posts = await conn.fetch(query, *params[:9], user_id)
+            posts = await conn.fetch(query, *params)
             result = [dict(post) for post in posts]
             
             # Кешируем полученные посты
@@ -260,13 +588,38 @@ class DatabaseService:
             
             return result
 
+    @staticmethod
+    async def _adjust_tag_counts(conn, post, delta: int):
+        # Счетчики фасетов меняются только при входе/выходе поста из ленты
+        tags = post['tags']
+        if not isinstance(tags, str):
+            tags = json.dumps(tags or [])
+        await conn.execute("""
+            INSERT INTO tag_counts (category, tag, approved_count)
+            SELECT DISTINCT $3::TEXT, t, GREATEST($2::INTEGER, 0) FROM jsonb_array_elements_text($1::jsonb) t
+            ON CONFLICT (category, tag) DO UPDATE
+            SET approved_count = GREATEST(tag_counts.approved_count + $2::INTEGER, 0)
+        """, tags, delta, post['category'])
+
+    @staticmethod
+    async def _set_post_status(conn, post_id: int, status: str) -> Optional[Dict]:
+        async with conn.transaction():
+            previous = await conn.fetchval("SELECT status FROM posts WHERE id = $1 FOR UPDATE", post_id)
+            if previous is None:
+                return None
+            post = await conn.fetchrow("UPDATE posts SET status = $2 WHERE id = $1 RETURNING *", post_id, status)
+            if previous != 'approved' and status == 'approved':
+                await DatabaseService._adjust_tag_counts(conn, post, 1)
+            elif previous == 'approved' and status != 'approved':
+                await DatabaseService._adjust_tag_counts(conn, post, -1)
+            dirty_hot_posts.add(post_id)
+            return dict(post)
+
     @staticmethod
     async def approve_post(post_id: int) -> Optional[Dict]:
         async with get_db_connection() as conn:
-            await conn.execute("UPDATE posts SET status = 'approved' WHERE id = $1", post_id)
-            post = await conn.fetchrow("SELECT * FROM posts WHERE id = $1", post_id)
-            if post:
-                post_dict = dict(post)
+            post_dict = await DatabaseService._set_post_status(conn, post_id, 'approved')
+            if post_dict:
                 posts_cache[post_id] = post_dict
                 return post_dict
             return None
@@ -274,25 +627,36 @@ class DatabaseService:
     @staticmethod
     async def reject_post(post_id: int) -> Optional[Dict]:
         async with get_db_connection() as conn:
-            await conn.execute("UPDATE posts SET status = 'rejected' WHERE id = $1", post_id)
-            post = await conn.fetchrow("SELECT * FROM posts WHERE id = $1", post_id)
-            if post:
+            post_dict = await DatabaseService._set_post_status(conn, post_id, 'rejected')
+            if post_dict:
                 # Удаляем из кеша
                 posts_cache.pop(post_id, None)
-                return dict(post)
+                return post_dict
             return None
 
     @staticmethod
     async def delete_post(post_id: int, user_id: int = None) -> bool:
         async with get_db_connection() as conn:
-            if user_id:
-                result = await conn.execute("DELETE FROM posts WHERE id = $1 AND user_id = $2", post_id, user_id)
-            else:
-                result = await conn.execute("DELETE FROM posts WHERE id = $1", post_id)
+            async with conn.transaction():
+                if user_id:
+                    deleted = await conn.fetchrow(
+                        "DELETE FROM posts WHERE id = $1 AND user_id = $2 RETURNING status, category, tags", post_id, user_id
+                    )
+                else:
+                    deleted = await conn.fetchrow("DELETE FROM posts WHERE id = $1 RETURNING status, category, tags", post_id)
+                
+                if deleted:
+                    await conn.execute("DELETE FROM user_favorites WHERE post_id = $1", post_id)
+                    await conn.execute("DELETE FROM user_hidden_posts WHERE post_id = $1", post_id)
+                    await conn.execute("DELETE FROM post_scores WHERE post_id = $1", post_id)
+                    await conn.execute("DELETE FROM post_reports WHERE post_id = $1", post_id)
+                    await conn.execute("DELETE FROM post_report_counts WHERE post_id = $1", post_id)
+                    if deleted['status'] == 'approved':
+                        await DatabaseService._adjust_tag_counts(conn, deleted, -1)
             
             # Удаляем из кеша
             posts_cache.pop(post_id, None)
-            return result.split()[-1] == '1'
+            return deleted is not None
 
     @staticmethod
     async def like_post(post_id: int, user_id: int) -> Optional[Dict]:
@@ -323,6 +687,7 @@ class DatabaseService:
                 """, post_id)
                 action = 'added'
             
+            dirty_hot_posts.add(post_id)
             post = await conn.fetchrow("SELECT * FROM posts WHERE id = $1", post_id)
             if post:
                 post_dict = dict(post)
@@ -335,22 +700,73 @@ class DatabaseService:
     @staticmethod
     async def report_post(post_id: int, reporter_id: int, reason: str = None) -> Dict:
         async with get_db_connection() as conn:
-            # Проверяем, жаловался ли пользователь на этот пост
-            user = await conn.fetchrow("SELECT reported_posts FROM users WHERE user_id = $1", reporter_id)
-            if user and user['reported_posts'] and post_id in user['reported_posts']:
-                return {'success': False, 'message': 'already_reported'}
-            
-            # Добавляем жалобу
-            await conn.execute("""
-                INSERT INTO post_reports (post_id, reporter_id, reason) VALUES ($1, $2, $3)
-            """, post_id, reporter_id, reason)
+            async with conn.transaction():
+                # Повторная жалоба отсекается уникальным индексом (post_id, reporter_id)
+                report_count = await conn.fetchval("""
+                    WITH inserted AS (
+                        INSERT INTO post_reports (post_id, reporter_id, reason) VALUES ($1, $2, $3)
+                        ON CONFLICT (post_id, reporter_id) DO NOTHING
+                        RETURNING post_id
+                    )
+                    INSERT INTO post_report_counts (post_id, report_count, last_reason, updated_at)
+                    SELECT post_id, 1, $3, CURRENT_TIMESTAMP FROM inserted
+                    ON CONFLICT (post_id) DO UPDATE
+                    SET report_count = post_report_counts.report_count + 1,
+                        last_reason = COALESCE(EXCLUDED.last_reason, post_report_counts.last_reason),
+                        updated_at = EXCLUDED.updated_at
+                    RETURNING report_count
+                """, post_id, reporter_id, reason)
+                
+                if report_count is None:
+                    return {'success': True, 'message': 'already_reported'}
+                
+                # Автоскрытие при достижении порога (в т.ч. если пост одобрили позже
+                # или порог снизили ниже уже накопленного счетчика)
+                auto_hidden = False
+                if report_count >= config.REPORT_AUTO_HIDE_THRESHOLD:
+                    status = await conn.fetchval("SELECT status FROM posts WHERE id = $1", post_id)
+                    if status == 'approved':
+                        await DatabaseService._set_post_status(conn, post_id, 'flagged')
+                        auto_hidden = True
             
-            # Добавляем пост в список пожалованных пользователем
+            if auto_hidden:
+                posts_cache.pop(post_id, None)
+            return {'success': True, 'message': 'reported', 'report_count': report_count, 'auto_hidden': auto_hidden}
+
+    @staticmethod
+    async def get_report_summary(post_id: int) -> Optional[Dict]:
+        async with get_db_connection() as conn:
+            row = await conn.fetchrow("""
+                SELECT p.id, p.creator, p.category, p.description, p.tags, p.status,
+                       c.report_count, c.last_reason, c.moderation_message_id
+                FROM post_report_counts c
+                JOIN posts p ON p.id = c.post_id
+                WHERE c.post_id = $1
+            """, post_id)
+            return dict(row) if row else None
+
+    @staticmethod
+    async def set_report_message_id(post_id: int, message_id: int):
+        async with get_db_connection() as conn:
             await conn.execute("""
-                UPDATE users SET reported_posts = array_append(reported_posts, $1) WHERE user_id = $2
-            """, post_id, reporter_id)
-            
-            return {'success': True, 'message': 'reported'}
+                UPDATE post_report_counts SET moderation_message_id = $2 WHERE post_id = $1
+            """, post_id, message_id)
+
+    @staticmethod
+    async def dismiss_reports(post_id: int) -> Optional[Dict]:
+        """Модератор оставил пост: сбрасываем счетчик и возвращаем автоскрытый пост в ленту"""
+        async with get_db_connection() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    UPDATE post_report_counts SET report_count = 0, moderation_message_id = NULL
+                    WHERE post_id = $1
+                """, post_id)
+                status = await conn.fetchval("SELECT status FROM posts WHERE id = $1", post_id)
+                if status != 'flagged':
+                    return None
+                post_dict = await DatabaseService._set_post_status(conn, post_id, 'approved')
+        posts_cache[post_id] = post_dict
+        return post_dict
 
     @staticmethod
     async def get_post_by_id(post_id: int) -> Optional[Dict]:
@@ -369,46 +785,46 @@ class DatabaseService:
     @staticmethod
     async def add_to_favorites(post_id: int, user_id: int) -> Dict:
         async with get_db_connection() as conn:
-            user = await conn.fetchrow("SELECT favorites FROM users WHERE user_id = $1", user_id)
-            if not user:
+            exists = await conn.fetchval("SELECT 1 FROM users WHERE user_id = $1", user_id)
+            if not exists:
                 return {'success': False, 'message': 'user_not_found'}
             
-            favorites = user['favorites'] or []
-            
-            if post_id in favorites:
-                # Убираем из избранного
-                await conn.execute("""
-                    UPDATE users SET favorites = array_remove(favorites, $1) WHERE user_id = $2
-                """, post_id, user_id)
+            # Убираем из избранного, если пост уже там
+            removed = await conn.execute("""
+                DELETE FROM user_favorites WHERE user_id = $1 AND post_id = $2
+            """, user_id, post_id)
+            if removed.split()[-1] != '0':
                 return {'success': True, 'action': 'removed', 'message': 'removed_from_favorites'}
-            else:
-                # Добавляем в избранное
-                await conn.execute("""
-                    UPDATE users SET favorites = array_append(favorites, $1) WHERE user_id = $2
-                """, post_id, user_id)
-                return {'success': True, 'action': 'added', 'message': 'added_to_favorites'}
+            
+            # Добавляем в избранное
+            await conn.execute("""
+                INSERT INTO user_favorites (user_id, post_id, post_created_at)
+                SELECT $1, id, created_at FROM posts WHERE id = $2
+                ON CONFLICT DO NOTHING
+            """, user_id, post_id)
+            return {'success': True, 'action': 'added', 'message': 'added_to_favorites'}
 
     @staticmethod
     async def hide_post(post_id: int, user_id: int) -> Dict:
         async with get_db_connection() as conn:
-            user = await conn.fetchrow("SELECT hidden FROM users WHERE user_id = $1", user_id)
-            if not user:
+            exists = await conn.fetchval("SELECT 1 FROM users WHERE user_id = $1", user_id)
+            if not exists:
                 return {'success': False, 'message': 'user_not_found'}
             
-            hidden = user['hidden'] or []
-            
-            if post_id in hidden:
-                # Показываем пост
-                await conn.execute("""
-                    UPDATE users SET hidden = array_remove(hidden, $1) WHERE user_id = $2
-                """, post_id, user_id)
+            # Показываем пост, если он был скрыт
+            removed = await conn.execute("""
+                DELETE FROM user_hidden_posts WHERE user_id = $1 AND post_id = $2
+            """, user_id, post_id)
+            if removed.split()[-1] != '0':
                 return {'success': True, 'action': 'shown', 'message': 'post_shown'}
-            else:
-                # Скрываем пост
-                await conn.execute("""
-                    UPDATE users SET hidden = array_append(hidden, $1) WHERE user_id = $2
-                """, post_id, user_id)
-                return {'success': True, 'action': 'hidden', 'message': 'post_hidden'}
+            
+            # Скрываем пост
+            await conn.execute("""
+                INSERT INTO user_hidden_posts (user_id, post_id, post_created_at)
+                SELECT $1, id, created_at FROM posts WHERE id = $2
+                ON CONFLICT DO NOTHING
+            """, user_id, post_id)
+            return {'success': True, 'action': 'hidden', 'message': 'post_hidden'}
 
     @staticmethod
     async def is_user_banned(user_id: int) -> bool:
@@ -449,6 +865,209 @@ class DatabaseService:
             """, user_id)
             return result or 0
 
+    @staticmethod
+    async def refresh_hot_scores(post_ids: List[int]):
+        async with get_db_connection() as conn:
+            async with conn.transaction():
+                await conn.execute(f"""
+                    INSERT INTO post_scores (post_id, post_created_at, score, updated_at)
+                    SELECT p.id, p.created_at, {HOT_SCORE_SQL}, CURRENT_TIMESTAMP FROM posts p
+                    WHERE p.id = ANY($2::BIGINT[]) AND p.status = 'approved'
+                    ON CONFLICT (post_id) DO UPDATE
+                    SET score = EXCLUDED.score, updated_at = EXCLUDED.updated_at
+                """, config.HOT_DECAY_SECONDS, post_ids)
+                # Отклоненные и удаленные посты убираем из рейтинга
+                await conn.execute("""
+                    DELETE FROM post_scores s
+                    WHERE s.post_id = ANY($1::BIGINT[])
+                      AND NOT EXISTS (
+                          SELECT 1 FROM posts p WHERE p.id = s.post_id AND p.status = 'approved'
+                      )
+                """, post_ids)
+
+    @staticmethod
+    async def backfill_hot_scores():
+        async with get_db_connection() as conn:
+            await conn.execute(f"""
+                INSERT INTO post_scores (post_id, post_created_at, score)
+                SELECT p.id, p.created_at, {HOT_SCORE_SQL} FROM posts p
+                WHERE p.status = 'approved'
+                  AND NOT EXISTS (SELECT 1 FROM post_scores s WHERE s.post_id = p.id)
+                ON CONFLICT (post_id) DO NOTHING
+            """, config.HOT_DECAY_SECONDS)
+
+    @staticmethod
+    async def get_tag_facets(category: str = None) -> Dict[str, Dict[str, int]]:
+        # Лента фильтруется по категории, поэтому и счетчики берем по ней
+        async with get_db_connection() as conn:
+            if category:
+                rows = await conn.fetch("""
+                    SELECT tag, approved_count FROM tag_counts
+                    WHERE category = $1 AND approved_count > 0
+                """, category)
+            else:
+                rows = await conn.fetch("""
+                    SELECT tag, SUM(approved_count)::INTEGER AS approved_count FROM tag_counts
+                    GROUP BY tag HAVING SUM(approved_count) > 0
+                """)
+        
+        # Теги хранятся как "{filter_type}:{value}"
+        facets = defaultdict(dict)
+        for row in rows:
+            filter_type, sep, value = row['tag'].partition(':')
+            if sep:
+                facets[filter_type][value] = row['approved_count']
+        return dict(facets)
+
+    @staticmethod
+    async def archive_posts() -> Dict:
+        """Переносит отклоненные и устаревшие посты в posts_archive"""
+        async with get_db_connection() as conn:
+            async with conn.transaction():
+                moved = await conn.fetch("""
+                    WITH moved AS (
+                        DELETE FROM posts
+                        WHERE (id, created_at) IN (
+                            SELECT id, created_at FROM posts
+                            WHERE (status = 'rejected'
+                                   AND created_at < CURRENT_TIMESTAMP - make_interval(days => $1))
+                               OR ($2 > 0 AND status = 'approved'
+                                   AND created_at < CURRENT_TIMESTAMP - make_interval(days => $2))
+                            LIMIT $3
+                        )
+                        RETURNING *
+                    ), archived AS (
+                        INSERT INTO posts_archive SELECT moved.*, CURRENT_TIMESTAMP FROM moved
+                    )
+                    SELECT id, status, category, tags FROM moved
+                """, config.ARCHIVE_REJECTED_AFTER_DAYS, config.POST_TTL_DAYS, config.ARCHIVE_BATCH_SIZE)
+                
+                if not moved:
+                    return {'archived': 0, 'removed_from_feed': []}
+                
+                post_ids = [row['id'] for row in moved]
+                await conn.execute("DELETE FROM user_favorites WHERE post_id = ANY($1::BIGINT[])", post_ids)
+                await conn.execute("DELETE FROM user_hidden_posts WHERE post_id = ANY($1::BIGINT[])", post_ids)
+                await conn.execute("DELETE FROM post_scores WHERE post_id = ANY($1::BIGINT[])", post_ids)
+                for row in moved:
+                    if row['status'] == 'approved':
+                        await DatabaseService._adjust_tag_counts(conn, row, -1)
+        
+        for post_id in post_ids:
+            posts_cache.pop(post_id, None)
+        return {
+            'archived': len(moved),
+            'removed_from_feed': [row['id'] for row in moved if row['status'] == 'approved']
+        }
+
+    @staticmethod
+    async def purge_orphaned_reports() -> int:
+        async with get_db_connection() as conn:
+            result = await conn.execute("""
+                DELETE FROM post_reports r
+                WHERE NOT EXISTS (SELECT 1 FROM posts p WHERE p.id = r.post_id)
+            """)
+            await conn.execute("""
+                DELETE FROM post_report_counts c
+                WHERE NOT EXISTS (SELECT 1 FROM posts p WHERE p.id = c.post_id)
+            """)
+            return int(result.split()[-1])
+
+    @staticmethod
+    async def create_upcoming_partitions():
+        async with get_db_connection() as conn:
+            await DatabaseService.ensure_post_partitions(conn)
+
+    @staticmethod
+    async def drop_empty_partitions():
+        # Старые месячные партиции после архивации обычно пусты
+        cutoff = date.today() - timedelta(days=max(config.POST_TTL_DAYS, config.ARCHIVE_REJECTED_AFTER_DAYS))
+        async with get_db_connection() as conn:
+            partitions = await conn.fetch("""
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'posts'::regclass
+            """)
+            for row in partitions:
+                match = re.fullmatch(r'posts_(\d{4})_(\d{2})', row['relname'])
+                if not match:
+                    continue
+                month = date(int(match.group(1)), int(match.group(2)), 1)
+                next_month = (month + timedelta(days=32)).replace(day=1)
+                if next_month > cutoff:
+                    continue
+                if not await conn.fetchval(f"SELECT EXISTS (SELECT 1 FROM {row['relname']})"):
+                    await conn.execute(f"DROP TABLE {row['relname']}")
+                    logger.info(f"Dropped empty partition {row['relname']}")
+
+# Фоновая архивация
+async def archive_posts_loop():
+    # Первый проход сразу после старта
+    while True:
+        # Партиции создаем отдельным шагом: сбой архивации не должен
+        # оставить новые посты в posts_default
+        try:
+            await DatabaseService.create_upcoming_partitions()
+        except Exception as e:
+            logger.error(f"Partition maintenance error: {e}")
+        
+        try:
+            archived_total = 0
+            while True:
+                result = await DatabaseService.archive_posts()
+                for post_id in result['removed_from_feed']:
+                    await broadcast_message({'type': 'post_deleted', 'post_id': post_id})
+                archived_total += result['archived']
+                if result['archived'] < config.ARCHIVE_BATCH_SIZE:
+                    break
+            purged = await DatabaseService.purge_orphaned_reports()
+            await DatabaseService.drop_empty_partitions()
+            logger.info(f"Archiver: {archived_total} posts archived, {purged} orphaned reports purged")
+        except Exception as e:
+            logger.error(f"Archiver error: {e}")
+        await asyncio.sleep(config.ARCHIVE_INTERVAL)
+
+# Фоновый пересчет рейтинга "hot"
+async def flush_hot_scores():
+    if not dirty_hot_posts:
+        return
+    post_ids = list(dirty_hot_posts)
+    dirty_hot_posts.clear()
+    try:
+        await DatabaseService.refresh_hot_scores(post_ids)
+    except BaseException:
+        # Не теряем изменения, пересчитаем в следующий раз
+        dirty_hot_posts.update(post_ids)
+        raise
+
+async def refresh_hot_scores_loop():
+    # dirty_hot_posts живет в памяти и теряется при падении процесса,
+    # поэтому при старте и периодически дозаполняем рейтинг одобренных постов без него
+    passes = 0
+    while True:
+        if passes % config.HOT_BACKFILL_EVERY == 0:
+            try:
+                await DatabaseService.backfill_hot_scores()
+            except Exception as e:
+                logger.error(f"Hot score backfill error: {e}")
+        passes += 1
+        
+        await asyncio.sleep(config.HOT_REFRESH_INTERVAL)
+        try:
+            await flush_hot_scores()
+        except Exception as e:
+            logger.error(f"Hot score refresh error: {e}")
+
+shutdown_hooks.append(flush_hot_scores)
+
+SCHEMA_MIGRATIONS = [
+    DatabaseService._migration_base_schema,
+    DatabaseService._migration_report_counts,
+    DatabaseService._migration_tag_counts_by_category,
+    DatabaseService._migration_link_post_created_at,
+]
+MIGRATION_LOCK_ID = 7_310_001
+
 # Система лимитов (в памяти)
 class PostLimitService:
     @staticmethod
@@ -457,12 +1076,42 @@ class PostLimitService:
         limit = await DatabaseService.get_user_limit(user_id)
         return posts_today < limit
 
+async def wait_for_bot() -> bool:
+    # Бот инициализируется параллельно с WebSocket сервером
+    if not telegram_bot:
+        try:
+            await asyncio.wait_for(bot_ready.wait(), config.BOT_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Moderation bot is not ready")
+    return telegram_bot is not None
+
+class StubTelegramBot:
+    """Отвечает на вызовы Bot, которые делает сервер, без обращения к Telegram"""
+    def __init__(self):
+        self.next_message_id = 0
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.next_message_id += 1
+        logger.debug(f"Stub send_message to {chat_id}")
+        return SimpleNamespace(message_id=self.next_message_id, chat_id=chat_id, text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None):
+        logger.debug(f"Stub edit_message_text {chat_id}/{message_id}")
+        return True
+
 # Telegram Bot
 class ModerationBot:
     def __init__(self):
         self.app = None
 
     async def init_bot(self):
+        global telegram_bot
+        if config.TELEGRAM_STUB:
+            telegram_bot = StubTelegramBot()
+            bot_ready.set()
+            logger.info("Moderation bot stubbed (TELEGRAM_STUB=1)")
+            return
+        
         if not config.BOT_TOKEN:
             raise ValueError("BOT_TOKEN not set")
         
@@ -476,8 +1125,8 @@ class ModerationBot:
         await self.app.initialize()
         await self.app.start()
         
-        global telegram_bot
         telegram_bot = self.app.bot
+        bot_ready.set()
         
         logger.info("Moderation bot initialized")
 
@@ -545,7 +1194,8 @@ class ModerationBot:
             if approved_post:
                 await broadcast_message({
                     'type': 'post_updated',
-                    'post': approved_post
+                    'post': approved_post,
+                    'approved': True
                 })
                 await query.edit_message_text("✅ Объявление одобрено и опубликовано")
             else:
@@ -564,6 +1214,23 @@ class ModerationBot:
                 logger.error(f"Failed to notify user: {e}")
             
             await query.edit_message_text("❌ Объявление отклонено")
+        
+        elif action == "delete":
+            if await DatabaseService.delete_post(post_id):
+                await broadcast_message({'type': 'post_deleted', 'post_id': post_id})
+                await query.edit_message_text(f"🗑 Объявление #{post_id} удалено по жалобам")
+            else:
+                await query.edit_message_text("❌ Ошибка при удалении объявления")
+        
+        elif action == "keep":
+            restored_post = await DatabaseService.dismiss_reports(post_id)
+            if restored_post:
+                await broadcast_message({
+                    'type': 'post_updated',
+                    'post': restored_post,
+                    'approved': True
+                })
+            await query.edit_message_text(f"✅ Объявление #{post_id} оставлено, жалобы сброшены")
 
     async def send_for_moderation(self, post: Dict):
         if not config.MODERATION_CHAT_ID:
@@ -600,46 +1267,185 @@ class ModerationBot:
             logger.error(f"Failed to send moderation message: {e}")
             return await DatabaseService.approve_post(post['id'])
 
-    async def send_report_for_moderation(self, post: Dict, reporter_data: Dict, reason: str = None):
+    async def send_report_summary(self, post_id: int):
+        """Одно сообщение на пост: отправляется при первой жалобе и редактируется дальше"""
         if not config.MODERATION_CHAT_ID:
             logger.warning("MODERATION_CHAT_ID not set, cannot send report")
             return
         
         try:
-            creator = json.loads(post['creator']) if isinstance(post['creator'], str) else post['creator']
+            summary = await DatabaseService.get_report_summary(post_id)
+            if not summary or summary['report_count'] == 0:
+                return
+            
+            creator = json.loads(summary['creator']) if isinstance(summary['creator'], str) else summary['creator']
+            reporter_data = last_reporters.pop(post_id, None)
             
             text = (
-                f"🚨 ЖАЛОБА НА ОБЪЯВЛЕНИЕ #{post['id']}\n\n"
+                f"🚨 ЖАЛОБЫ НА ОБЪЯВЛЕНИЕ #{summary['id']}\n\n"
+                f"📊 Жалоб: {summary['report_count']} (порог скрытия: {config.REPORT_AUTO_HIDE_THRESHOLD})\n"
+                f"👁 Статус: {'скрыто автоматически' if summary['status'] == 'flagged' else summary['status']}\n\n"
                 f"👤 Автор объявления: {creator['first_name']} {creator.get('last_name', '')}\n"
                 f"🆔 ID автора: {creator['user_id']}\n"
                 f"👤 Username автора: @{creator.get('username', 'нет')}\n\n"
-                f"🚨 Жалобу подал: {reporter_data['first_name']} {reporter_data.get('last_name', '')}\n"
-                f"🆔 ID жалобщика: {reporter_data['user_id']}\n"
-                f"👤 Username жалобщика: @{reporter_data.get('username', 'нет')}\n\n"
-                f"📂 Категория: {post['category']}\n"
-                f"📄 Текст объявления:\n{post['description']}\n\n"
-                f"🏷 Теги: {', '.join(json.loads(post['tags']) if post['tags'] else [])}\n\n"
-                f"💬 Причина жалобы: {reason or 'Не указана'}"
+            )
+            if reporter_data:
+                text += (
+                    f"🚨 Последняя жалоба: {reporter_data['first_name']} {reporter_data.get('last_name', '')}\n"
+                    f"🆔 ID жалобщика: {reporter_data['user_id']}\n"
+                    f"👤 Username жалобщика: @{reporter_data.get('username', 'нет')}\n\n"
+                )
+            text += (
+                f"📂 Категория: {summary['category']}\n"
+                f"📄 Текст объявления:\n{summary['description']}\n\n"
+                f"🏷 Теги: {', '.join(json.loads(summary['tags']) if summary['tags'] else [])}\n\n"
+                f"💬 Последняя причина: {summary['last_reason'] or 'Не указана'}"
             )
             
             keyboard = InlineKeyboardMarkup([
                 [
-                    InlineKeyboardButton("🗑 Удалить объявление", callback_data=f"delete_{post['id']}"),
-                    InlineKeyboardButton("✅ Оставить", callback_data=f"keep_{post['id']}")
+                    InlineKeyboardButton("🗑 Удалить объявление", callback_data=f"delete_{summary['id']}"),
+                    InlineKeyboardButton("✅ Оставить", callback_data=f"keep_{summary['id']}")
                 ]
             ])
             
-            await telegram_bot.send_message(
-                chat_id=config.MODERATION_CHAT_ID,
-                text=text,
-                reply_markup=keyboard
-            )
+            if summary['moderation_message_id']:
+                await telegram_bot.edit_message_text(
+                    chat_id=config.MODERATION_CHAT_ID,
+                    message_id=summary['moderation_message_id'],
+                    text=text,
+                    reply_markup=keyboard
+                )
+            else:
+                message = await telegram_bot.send_message(
+                    chat_id=config.MODERATION_CHAT_ID,
+                    text=text,
+                    reply_markup=keyboard
+                )
+                await DatabaseService.set_report_message_id(post_id, message.message_id)
             
         except Exception as e:
             logger.error(f"Failed to send report message: {e}")
 
+# Сводки жалоб: жалобы за REPORT_SUMMARY_DELAY объединяются в одно обновление
+def schedule_report_summary(post_id: int, reporter_data: Dict):
+    last_reporters[post_id] = reporter_data
+    if post_id not in report_summary_tasks:
+        report_summary_tasks[post_id] = asyncio.create_task(send_report_summary_later(post_id))
+
+async def send_report_summary_later(post_id: int):
+    await asyncio.sleep(config.REPORT_SUMMARY_DELAY)
+    # Жалобы, пришедшие во время отправки, запланируют новое обновление
+    report_summary_tasks.pop(post_id, None)
+    if await wait_for_bot():
+        await ModerationBot().send_report_summary(post_id)
+
+async def flush_report_summaries():
+    post_ids = list(report_summary_tasks)
+    for task in report_summary_tasks.values():
+        task.cancel()
+    report_summary_tasks.clear()
+    for post_id in post_ids:
+        await ModerationBot().send_report_summary(post_id)
+
+shutdown_hooks.append(flush_report_summaries)
+
+# Журнал событий ленты для переподключающихся клиентов
+class FeedEventLog:
+    EVENT_TYPES = ('post_updated', 'post_deleted')
+
+    def __init__(self, size: int):
+        # epoch меняется при каждом запуске, seq после рестарта начинается заново
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.events = deque(maxlen=size)
+
+    def position(self) -> Dict:
+        return {'epoch': self.epoch, 'seq': self.seq}
+
+    def record(self, message: Dict) -> Dict:
+        self.seq += 1
+        message = {**message, 'seq': self.seq}
+        self.events.append(message)
+        return message
+
+    def delta_since(self, epoch: str, last_seq: int) -> Optional[Dict]:
+        """Изменения после last_seq или None, если нужна полная перезагрузка"""
+        if not isinstance(last_seq, int) or isinstance(last_seq, bool):
+            return None
+        if epoch != self.epoch or last_seq > self.seq:
+            return None
+        oldest_seq = self.events[0]['seq'] if self.events else self.seq + 1
+        if last_seq < oldest_seq - 1:
+            return None
+        
+        deleted = set()
+        updated = {}
+        approved = {}
+        for event in self.events:
+            if event['seq'] <= last_seq:
+                continue
+            if event['type'] == 'post_deleted':
+                post_id = event['post_id']
+                deleted.add(post_id)
+                updated.pop(post_id, None)
+                approved.pop(post_id, None)
+            else:
+                post = event['post']
+                post_id = post['id']
+                deleted.discard(post_id)
+                if event.get('approved') or post_id in approved:
+                    approved[post_id] = post
+                    updated.pop(post_id, None)
+                else:
+                    updated[post_id] = post
+        
+        return {
+            'deleted': sorted(deleted),
+            'updated': list(updated.values()),
+            'approved': list(approved.values())
+        }
+
+feed_events = FeedEventLog(config.FEED_EVENT_BUFFER_SIZE)
+
+# Запись трафика: одна JSON-строка на входящее сообщение, только дописывание
+class TrafficCapture:
+    def __init__(self, path: str):
+        self.path = path
+        # Построчная буферизация: при падении процесса теряется не больше одной строки
+        self.file = open(path, 'a', encoding='utf-8', buffering=1)
+        self.connections = 0
+
+    def new_connection_id(self) -> str:
+        # epoch отличает соединения разных запусков в одном файле
+        self.connections += 1
+        return f"{feed_events.epoch[:8]}-{self.connections}"
+
+    def record(self, connection_id: str, arrived_at: float, action: Optional[str], elapsed_ms: float, message):
+        # Обработчики, пережившие остановку, могут писать после close()
+        if self.file.closed:
+            return
+        if isinstance(message, bytes):
+            message = message.decode('utf-8', 'replace')
+        self.file.write(json.dumps({
+            't': round(arrived_at, 4),
+            'c': connection_id,
+            'a': action,
+            'ms': elapsed_ms,
+            'm': message
+        }, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    async def close(self):
+        self.file.close()
+
+traffic_capture = TrafficCapture(config.CAPTURE_PATH) if config.CAPTURE_PATH else None
+
 # WebSocket
 async def broadcast_message(message: Dict, filter_data: Dict = None):
+    # События ленты нумеруются и сохраняются для resume
+    if message.get('type') in FeedEventLog.EVENT_TYPES:
+        message = feed_events.record(message)
+    
     if connected_clients:
         message_str = json.dumps(message)
         disconnected_clients = set()
@@ -657,28 +1463,175 @@ async def broadcast_message(message: Dict, filter_data: Dict = None):
                 logger.error(f"Error broadcasting to client: {e}")
                 disconnected_clients.add(client)
         
-        connected_clients -= disconnected_clients
+        connected_clients.difference_update(disconnected_clients)
+
+def get_client_ip(websocket: WebSocketServerProtocol) -> str:
+    peer_ip = websocket.remote_address[0] if websocket.remote_address else 'unknown'
+    
+    # X-Forwarded-For учитываем только от доверенного прокси, иначе его подделает любой клиент
+    forwarded = websocket.request_headers.get('X-Forwarded-For')
+    if not forwarded or peer_ip not in config.TRUSTED_PROXIES:
+        return peer_ip
+    
+    # Берем самый правый адрес, добавленный не нашими прокси
+    for ip in reversed([ip.strip() for ip in forwarded.split(',') if ip.strip()]):
+        if ip not in config.TRUSTED_PROXIES:
+            return ip
+    return peer_ip
+
+def get_trace_id(message) -> Optional[str]:
+    # Разбираем JSON только для сообщений replay.py, сброс нагрузки должен оставаться дешевым
+    if not isinstance(message, str) or '_trace' not in message:
+        return None
+    try:
+        data = json.loads(message)
+    except json.JSONDecodeError:
+        return None
+    return data.get('_trace') if isinstance(data, dict) else None
 
 async def handle_websocket(websocket: WebSocketServerProtocol):
+    client_ip = get_client_ip(websocket)
+    
+    # Контроль допуска новых соединений
+    if server_state['shutting_down']:
+        await send_reconnect_hint(websocket)
+        await websocket.close(1012, 'Service restart')
+        return
+    if len(connected_clients) >= config.WS_MAX_CONNECTIONS:
+        ws_stats['rejected_max_connections'] += 1
+        await websocket.close(1013, 'Server is full')
+        return
+    if ip_connections[client_ip] >= config.WS_MAX_CONNECTIONS_PER_IP:
+        ws_stats['rejected_per_ip'] += 1
+        await websocket.close(1013, 'Too many connections')
+        return
+    
     connected_clients.add(websocket)
+    client_ips[websocket] = client_ip
+    client_last_seen[websocket] = time.monotonic()
+    ip_connections[client_ip] += 1
+    connection_id = traffic_capture.new_connection_id() if traffic_capture else None
     logger.info(f"Client connected. Total clients: {len(connected_clients)}")
     
     try:
         async for message in websocket:
+            client_last_seen[websocket] = time.monotonic()
+            arrived_at = time.time()
+            started = time.perf_counter()
+            
+            shed_reply = None
+            if server_state['shutting_down']:
+                # Во время остановки новые действия не принимаем
+                shed_reply = 'reconnect'
+                await send_reconnect_hint(websocket)
+            elif db_stats['waiting'] >= config.DB_MAX_QUEUE:
+                # Сброс нагрузки, если очередь к пулу БД слишком длинная
+                shed_reply = 'overloaded'
+                ws_stats['shed_messages'] += 1
+                await websocket.send(json.dumps({
+                    'type': 'overloaded',
+                    'message': 'Сервер перегружен, повторите запрос позже',
+                    'retry_after': config.OVERLOAD_RETRY_AFTER
+                }))
+            
+            if shed_reply:
+                elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+                if traffic_capture:
+                    traffic_capture.record(connection_id, arrived_at, shed_reply, elapsed_ms, message)
+                trace_id = get_trace_id(message)
+                if trace_id is not None:
+                    await websocket.send(json.dumps({
+                        'type': 'trace_ack', '_trace': trace_id, 'ms': elapsed_ms,
+                        'shed': True, 'reply': shed_reply
+                    }))
+                continue
+            
+            server_state['inflight'] += 1
+            action = None
+            trace_id = None
             try:
                 data = json.loads(message)
+                action = data.get('type')
+                trace_id = data.get('_trace')
                 await handle_websocket_message(websocket, data)
             except json.JSONDecodeError:
                 await websocket.send(json.dumps({'type': 'error', 'message': 'Invalid JSON'}))
             except Exception as e:
                 logger.error(f"WebSocket message error: {e}")
                 await websocket.send(json.dumps({'type': 'error', 'message': str(e)}))
+            finally:
+                server_state['inflight'] -= 1
+                if server_state['inflight'] == 0:
+                    inflight_done.set()
+                
+                elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+                if traffic_capture:
+                    traffic_capture.record(connection_id, arrived_at, action, elapsed_ms, message)
+            
+            # Для replay.py: все ответы на это сообщение уже отправлены
+            if trace_id is not None:
+                await websocket.send(json.dumps({'type': 'trace_ack', '_trace': trace_id, 'ms': elapsed_ms}))
     except websockets.exceptions.ConnectionClosed:
         pass
     finally:
         connected_clients.discard(websocket)
+        client_ips.pop(websocket, None)
+        client_last_seen.pop(websocket, None)
+        ip_connections[client_ip] -= 1
+        if ip_connections[client_ip] <= 0:
+            del ip_connections[client_ip]
+        
+        # Причины отключения для планирования емкости.
+        # При ошибке сервер сам отправляет close frame, а мертвый клиент не отвечает,
+        # поэтому смотрим код отправленного фрейма, а не close_code (он будет 1006)
+        sent_code = websocket.close_sent.code if websocket.close_sent else None
+        if sent_code == 1009:
+            ws_stats['closed_message_too_big'] += 1
+        elif sent_code == 1011:
+            ws_stats['closed_heartbeat_timeout'] += 1
+        elif websocket.close_code == 1006:
+            ws_stats['closed_abnormal'] += 1
         logger.info(f"Client disconnected. Total clients: {len(connected_clients)}")
 
+async def evict_idle_clients():
+    """Периодически отключает клиентов, которые давно ничего не отправляли"""
+    if config.WS_IDLE_TIMEOUT <= 0:
+        return
+    while True:
+        await asyncio.sleep(config.WS_IDLE_CHECK_INTERVAL)
+        deadline = time.monotonic() - config.WS_IDLE_TIMEOUT
+        idle_clients = [client for client, last_seen in client_last_seen.items() if last_seen < deadline]
+        if idle_clients:
+            ws_stats['evicted_idle'] += len(idle_clients)
+            logger.info(f"Evicting {len(idle_clients)} idle clients")
+            await asyncio.gather(
+                *(client.close(1001, 'Idle timeout') for client in idle_clients),
+                return_exceptions=True
+            )
+
+async def send_reconnect_hint(websocket: WebSocketServerProtocol):
+    # Разброс задержки, чтобы клиенты не переподключались одновременно
+    retry_after = config.RECONNECT_BASE_DELAY + random.uniform(0, config.RECONNECT_JITTER)
+    try:
+        await websocket.send(json.dumps({
+            'type': 'reconnect',
+            'retry_after': round(retry_after, 2),
+            'feed': feed_events.position()
+        }))
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+def get_connection_stats() -> Dict:
+    return {
+        'shutting_down': server_state['shutting_down'],
+        'connections': len(connected_clients),
+        'unique_ips': len(ip_connections),
+        'max_connections': config.WS_MAX_CONNECTIONS,
+        'db_waiting': db_stats['waiting'],
+        'startup': startup_stats,
+        'events': dict(ws_stats)
+    }
+
 async def handle_websocket_message(websocket: WebSocketServerProtocol, data: Dict):
     action = data.get('type')
     user_id = data.get('user_id')
@@ -692,6 +1645,8 @@ async def handle_websocket_message(websocket: WebSocketServerProtocol, data: Dic
         return
     
     if action == 'sync_user':
+        # Позицию берем до запроса: события во время запроса получат seq больше нее
+        feed_position = feed_events.position()
         user_data = await DatabaseService.sync_user(data)
         published_count = await DatabaseService.get_user_published_posts_count(user_id)
         await websocket.send(json.dumps({
@@ -701,9 +1656,25 @@ async def handle_websocket_message(websocket: WebSocketServerProtocol, data: Dic
                 'used': published_count,
                 'total': user_data.get('post_limit', config.DAILY_POST_LIMIT)
             },
-            'is_banned': user_data.get('is_banned', False)
+            'is_banned': user_data.get('is_banned', False),
+            'feed': feed_position
         }))
     
+    elif action == 'resume':
+        # Клиент переподключился: отдаем только изменения с последнего seq
+        delta = feed_events.delta_since(data.get('epoch'), data.get('last_seq', 0))
+        if delta is None:
+            await websocket.send(json.dumps({
+                'type': 'resync_required',
+                'feed': feed_events.position()
+            }))
+        else:
+            await websocket.send(json.dumps({
+                'type': 'resume_delta',
+                'feed': feed_events.position(),
+                **delta
+            }))
+    
     elif action == 'create_post':
         # Проверка лимита
         if not await PostLimitService.check_user_limit(user_id):
@@ -723,7 +1694,7 @@ async def handle_websocket_message(websocket: WebSocketServerProtocol, data: Dic
         })
         
         # Отправляем на модерацию
-        if telegram_bot:
+        if await wait_for_bot():
             moderation_bot = ModerationBot()
             await moderation_bot.send_for_moderation(post)
         
@@ -741,15 +1712,21 @@ async def handle_websocket_message(websocket: WebSocketServerProtocol, data: Dic
         }))
     
     elif action == 'get_posts':
+        feed_position = feed_events.position()
         posts = await DatabaseService.get_posts(
             data, data['page'], data['limit'], data.get('search', ''), user_id
         )
         await websocket.send(json.dumps({
             'type': 'posts',
             'posts': posts,
-            'append': data.get('append', False)
+            'append': data.get('append', False),
+            'feed': feed_position
         }))
     
+    elif action == 'get_facets':
+        facets = await DatabaseService.get_tag_facets(data.get('category'))
+        await websocket.send(json.dumps({'type': 'facets', 'facets': facets}))
+    
     elif action == 'like_post':
         post = await DatabaseService.like_post(data['post_id'], user_id)
         if post:
@@ -788,16 +1765,16 @@ async def handle_websocket_message(websocket: WebSocketServerProtocol, data: Dic
                         'message': 'Вы уже отправляли жалобу на это объявление'
                     }))
                 else:
-                    # Отправляем жалобу модераторам
-                    if telegram_bot:
-                        moderation_bot = ModerationBot()
-                        reporter_data = {
-                            'user_id': user_id,
-                            'first_name': data.get('reporter_first_name', ''),
-                            'last_name': data.get('reporter_last_name', ''),
-                            'username': data.get('reporter_username', '')
-                        }
-                        await moderation_bot.send_report_for_moderation(post, reporter_data, data.get('reason'))
+                    # Обновляем сводку жалоб у модераторов (с задержкой, одним сообщением)
+                    schedule_report_summary(data['post_id'], {
+                        'user_id': user_id,
+                        'first_name': data.get('reporter_first_name', ''),
+                        'last_name': data.get('reporter_last_name', ''),
+                        'username': data.get('reporter_username', '')
+                    })
+                    
+                    if result['auto_hidden']:
+                        await broadcast_message({'type': 'post_deleted', 'post_id': data['post_id']})
                     
                     await websocket.send(json.dumps({
                         'type': 'report_sent',
@@ -836,10 +1813,18 @@ async def serve_static_files():
     
     async def health_handler(request):
         """Health check endpoint"""
+        # Готовы только когда WebSocket сервер принимает соединения
+        if 'websocket_ready' not in startup_stats:
+            return web.Response(text="Starting", status=503)
         return web.Response(text="OK", status=200)
     
+    async def metrics_handler(request):
+        """Счетчики соединений и отключений"""
+        return web.json_response(get_connection_stats())
+    
     app = web.Application()
     app.router.add_get('/health', health_handler)
+    app.router.add_get('/metrics', metrics_handler)
     app.router.add_get('/', index_handler)
     app.router.add_get('/{path:.*}', index_handler)  # Catch-all для SPA
     
@@ -848,36 +1833,127 @@ async def serve_static_files():
     
     # Используем порт на 1 больше чем WebSocket
     http_port = config.PORT + 1
-    site = web.TCPSite(runner, '0.0.0.0', http_port)
+    site = web.TCPSite(runner, '0.0.0.0', http_port, reuse_port=config.REUSE_PORT or None)
     await site.start()
     logger.info(f"HTTP server started on port {http_port}")
+    return runner
+
+# Плавная остановка
+async def shutdown(server, moderation_bot: ModerationBot, http_runner):
+    logger.info("Shutting down...")
+    server_state['shutting_down'] = True
+    
+    # Перестаем принимать новые соединения, существующие пока не трогаем
+    server.close(close_connections=False)
+    
+    # Подсказываем клиентам переподключиться с разбросом задержки
+    await asyncio.gather(
+        *(send_reconnect_hint(client) for client in connected_clients.copy()),
+        return_exceptions=True
+    )
+    
+    # Дожидаемся завершения начатых действий (в т.ч. отправки на модерацию)
+    if server_state['inflight'] > 0:
+        inflight_done.clear()
+        try:
+            await asyncio.wait_for(inflight_done.wait(), config.SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutdown drain timed out with {server_state['inflight']} actions in flight")
+    
+    # Сбрасываем отложенные записи
+    for hook in shutdown_hooks:
+        try:
+            await hook()
+        except Exception as e:
+            logger.error(f"Shutdown hook error: {e}")
+    
+    await asyncio.gather(
+        *(client.close(1012, 'Service restart') for client in connected_clients.copy()),
+        return_exceptions=True
+    )
+    await server.wait_closed()
+    
+    # Файл записи закрываем только когда все обработчики завершились
+    if traffic_capture:
+        await traffic_capture.close()
+    
+    if moderation_bot.app:
+        if moderation_bot.app.updater and moderation_bot.app.updater.running:
+            await moderation_bot.app.updater.stop()
+        if moderation_bot.app.running:
+            await moderation_bot.app.stop()
+        await moderation_bot.app.shutdown()
+    
+    if http_runner:
+        await http_runner.cleanup()
+    
+    if db_pool:
+        try:
+            await asyncio.wait_for(db_pool.close(), config.SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Database pool did not close in time, terminating")
+            db_pool.terminate()
+    
+    logger.info("Shutdown complete")
 
 # Основная функция
 async def main():
-    # Инициализация базы данных
-    await DatabaseService.init_database()
-    
-    # Инициализация бота
+    started_at = time.monotonic()
     moderation_bot = ModerationBot()
-    await moderation_bot.init_bot()
     
-    # Запуск HTTP сервера для статических файлов
-    await serve_static_files()
+    # Бот и HTTP сервер не нужны для приема WebSocket соединений,
+    # поэтому инициализируются параллельно с базой данных
+    bot_task = asyncio.create_task(moderation_bot.init_bot())
+    http_task = asyncio.create_task(serve_static_files())
     
-    # Запуск WebSocket сервера
-    server = await websockets.serve(handle_websocket, '0.0.0.0', config.PORT)
-    logger.info(f"WebSocket server started on port {config.PORT}")
+    # Инициализация базы данных
+    try:
+        await DatabaseService.init_database()
+    except BaseException:
+        bot_task.cancel()
+        http_task.cancel()
+        raise
+    startup_stats['db_ready'] = round(time.monotonic() - started_at, 3)
     
-    # Запуск бота
-    await moderation_bot.app.updater.start_polling()
+    # Запуск WebSocket сервера сразу после готовности пула
+    # С REUSE_PORT новый процесс может занять порт до остановки старого
+    server = await websockets.serve(
+        handle_websocket, '0.0.0.0', config.PORT,
+        max_size=config.WS_MAX_MESSAGE_SIZE,
+        ping_interval=config.WS_PING_INTERVAL,
+        ping_timeout=config.WS_PING_TIMEOUT,
+        reuse_port=config.REUSE_PORT or None
+    )
+    startup_stats['websocket_ready'] = round(time.monotonic() - started_at, 3)
+    logger.info(f"WebSocket server started on port {config.PORT} in {startup_stats['websocket_ready']}s")
+    idle_task = asyncio.create_task(evict_idle_clients())
+    hot_task = asyncio.create_task(refresh_hot_scores_loop())
+    archive_task = asyncio.create_task(archive_posts_loop())
     
+    # Ждем SIGTERM/SIGINT
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    http_runner = None
     try:
-        await asyncio.Future()
-    except KeyboardInterrupt:
-        logger.info("Shutting down...")
+        http_runner = await http_task
+        await bot_task
+        
+        # Запуск бота
+        if moderation_bot.app:
+            await moderation_bot.app.updater.start_polling()
+        startup_stats['bot_ready'] = round(time.monotonic() - started_at, 3)
+        logger.info(f"Startup complete in {startup_stats['bot_ready']}s")
+        
+        await stop_event.wait()
     finally:
-        await moderation_bot.app.stop()
-        server.close()
+        bot_task.cancel()
+        idle_task.cancel()
+        hot_task.cancel()
+        archive_task.cancel()
+        await shutdown(server, moderation_bot, http_runner)
 
 if __name__ == '__main__':
     try:
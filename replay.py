@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+replay.py - воспроизведение записанного WebSocket трафика
+Читает журнал, записанный сервером с CAPTURE_PATH, и повторяет его против
+локального сервера (запущенного с TELEGRAM_STUB=1) с сохранением интервалов
+между сообщениями. В конце печатает распределение задержек по типам действий.
+
+Использование:
+    python replay.py capture.log --url ws://localhost:10000 --speed 10
+    python replay.py capture.log --speed 0   # без пауз, максимально быстро
+"""
+
+import argparse
+import asyncio
+import json
+from collections import defaultdict
+from typing import Dict, List
+
+import websockets
+
+def load_capture(path: str) -> Dict[str, List[Dict]]:
+    # Сообщения группируются по соединениям в порядке поступления
+    connections = defaultdict(list)
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entry = json.loads(line)
+                connections[entry['c']].append(entry)
+    for entries in connections.values():
+        entries.sort(key=lambda entry: entry['t'])
+    return connections
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+async def replay_connection(url: str, entries: List[Dict], start_time: float, replay_started: float,
+                            speed: float, results: Dict[str, List[float]], timeout: float):
+    loop = asyncio.get_running_loop()
+    pending = {}
+
+    # Соединение открывается к моменту первого сообщения, как в исходном трафике
+    if speed > 0:
+        delay = replay_started + (entries[0]['t'] - start_time) / speed - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async with websockets.connect(url, max_size=None) as websocket:
+        async def read_acks():
+            # Остальные ответы и broadcast-сообщения игнорируем
+            async for message in websocket:
+                data = json.loads(message)
+                if data.get('type') == 'trace_ack' and data.get('_trace') in pending:
+                    pending.pop(data['_trace']).set_result(data)
+
+        reader = asyncio.create_task(read_acks())
+        try:
+            for number, entry in enumerate(entries):
+                # Сохраняем исходные интервалы, деленные на скорость
+                if speed > 0:
+                    delay = replay_started + (entry['t'] - start_time) / speed - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                try:
+                    data = json.loads(entry['m'])
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(data, dict):
+                    continue
+
+                trace_id = f"{entry['c']}:{number}"
+                data['_trace'] = trace_id
+                ack = loop.create_future()
+                pending[trace_id] = ack
+
+                sent_at = loop.time()
+                await websocket.send(json.dumps(data))
+                # В записи сброшенные сообщения помечены как overloaded/reconnect,
+                # при повторе берем исходное действие из самого сообщения
+                action = data.get('type') or entry.get('a') or 'unknown'
+                try:
+                    ack_data = await asyncio.wait_for(ack, timeout)
+                    # Сброшенные сервером сообщения считаем отдельно от обработанных
+                    if ack_data.get('shed'):
+                        action = ack_data.get('reply') or 'shed'
+                    results[action].append((loop.time() - sent_at) * 1000)
+                except asyncio.TimeoutError:
+                    pending.pop(trace_id, None)
+                    results[f"{action} (timeout)"].append(timeout * 1000)
+        finally:
+            reader.cancel()
+
+def print_report(results: Dict[str, List[float]], captured: Dict[str, List[float]]):
+    header = f"{'action':<24}{'count':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}{'captured p50':>15}"
+    print(header)
+    print('-' * len(header))
+    for action in sorted(results):
+        values = results[action]
+        captured_values = captured.get(action)
+        captured_p50 = f"{percentile(captured_values, 50):.1f}" if captured_values else '-'
+        print(
+            f"{action:<24}{len(values):>8}"
+            f"{percentile(values, 50):>10.1f}{percentile(values, 90):>10.1f}"
+            f"{percentile(values, 99):>10.1f}{max(values):>10.1f}{captured_p50:>15}"
+        )
+    print("\nВремя в миллисекундах")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay captured WebSocket traffic")
+    parser.add_argument('capture', help="Файл, записанный сервером с CAPTURE_PATH")
+    parser.add_argument('--url', default='ws://localhost:10000')
+    parser.add_argument('--speed', type=float, default=1.0, help="1 - реальное время, 10 - в 10 раз быстрее, 0 - без пауз")
+    parser.add_argument('--timeout', type=float, default=30.0, help="Ожидание ответа на одно сообщение, секунды")
+    args = parser.parse_args()
+
+    connections = load_capture(args.capture)
+    if not connections:
+        print("Capture is empty")
+        return
+
+    # Задержки, измеренные сервером при записи, для сравнения
+    captured = defaultdict(list)
+    for entries in connections.values():
+        for entry in entries:
+            captured[entry.get('a') or 'unknown'].append(entry['ms'])
+
+    start_time = min(entries[0]['t'] for entries in connections.values())
+    results = defaultdict(list)
+    loop = asyncio.get_running_loop()
+    replay_started = loop.time()
+
+    outcomes = await asyncio.gather(
+        *(replay_connection(args.url, entries, start_time, replay_started, args.speed, results, args.timeout)
+          for entries in connections.values()),
+        return_exceptions=True
+    )
+    failed = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+
+    print(f"Replayed {len(connections)} connections in {loop.time() - replay_started:.1f}s"
+          f" ({len(failed)} failed)\n")
+    print_report(results, captured)
+
+if __name__ == '__main__':
+    asyncio.run(main())